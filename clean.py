@@ -5,7 +5,13 @@ import ciso8601
 import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
 import requests
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pyarrow import csv
+from tempfile import SpooledTemporaryFile
 from zipfile import ZipFile
 
 # This code cleans the enron and seattle datasets.
@@ -23,36 +29,26 @@ from zipfile import ZipFile
 #    approach to entity resolution.
 
 
+# Characters stripped from user names, and Seattle's trailing address or
+# comment, each removed in one regex pass over the column.
+ENRON_STRIP = r"[\[\]'\" ]"
+SEATTLE_STRIP = r"['\" ]"
+SEATTLE_CUT = r"(?s)[<(].*"
+
+
 def clean_enron(s):
     """
-    Cleans Enron user names.
+    Cleans a Series of Enron user names.
     """
-    if type(s) is str:
-        s = s.replace("[", "")
-        s = s.replace("]", "")
-        s = s.replace("\'", "")
-        s = s.replace("\"", "")
-        s = s.replace(" ", "")
-
-        return s
-    else:
-        return ""
+    return s.fillna("").str.replace(ENRON_STRIP, "", regex=True)
 
 
 def clean_seattle(s):
     """
-    Cleans Seattle user names.
+    Cleans a Series of Seattle user names.
     """
-    if type(s) is str:
-        s = s.split("<")[0]
-        s = s.split("(")[0]
-        s = s.replace("\"", "")
-        s = s.replace("\'", "")
-        s = s.replace(" ", "")
-
-        return s
-    else:
-        return ""
+    s = s.fillna("").str.replace(SEATTLE_CUT, "", regex=True)
+    return s.str.replace(SEATTLE_STRIP, "", regex=True)
 
 
 ENRON_PARAMETERS = (
@@ -62,8 +58,6 @@ ENRON_PARAMETERS = (
     {  # rename
         "From": "sender",
         "To": "receiver",
-        "X-cc": "cc",
-        "X-bcc": "bcc",
         "Date": "submit"
     },
     clean_enron,  # cleaning function
@@ -78,8 +72,6 @@ SEATTLE_PARAMETERS = (
     {  # rename
         "sender": "sender",
         "to": "receiver",
-        "cc": "cc",
-        "bcc": "bcc",
         "time": "submit"
     },
     clean_seattle,  # cleaning function
@@ -88,100 +80,157 @@ SEATTLE_PARAMETERS = (
 )
 
 
-def download(url, file_path, data_path):
+def download(url, data_path):
     """
-    Downloads the file at url and saves it to file_path.
+    Downloads the zip file at url and extracts it into data_path. The archive
+    is kept in memory, spilling to a temporary file past 1 GiB.
     """
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(file_path, "wb") as file:
-            for d in r.iter_content(chunk_size=8192):
-                file.write(d)
+    with SpooledTemporaryFile(max_size=1 << 30) as buffer:
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, buffer, length=1 << 20)
 
-    with ZipFile(file_path) as z:
-        z.extractall(path=data_path)
+        with ZipFile(buffer) as z:
+            z.extractall(path=data_path)
 
 
-def clean_multiple(s, clean_fn, delimiter):
-    """
-    Cleans multiple user names.
+# The strings pd.read_csv treats as missing by default.
+NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a",
+    "nan", "null",
+]
+
 
-    s - the user names in a string.
-    clean_fn - the function to clean individual user names.
-    delimiter - the string that marks the end of a user name.
+def read_raw(raw_path, rename):
+    """
+    Reads the columns in rename from the raw csv as Arrow-backed strings and
+    renames them.
+    """
+    try:
+        table = csv.read_csv(
+            raw_path,
+            parse_options=csv.ParseOptions(newlines_in_values=True),
+            convert_options=csv.ConvertOptions(
+                include_columns=list(rename),
+                column_types={c: pa.string() for c in rename},
+                null_values=NULL_VALUES,
+                strings_can_be_null=True))
+    except pa.ArrowInvalid:
+        # Arrow cannot split a record larger than its read block when values
+        # may contain newlines, so fall back to pandas' reader.
+        df = pd.read_csv(raw_path, usecols=list(rename),
+                         dtype=pd.ArrowDtype(pa.string()))
+        return df[list(rename)].rename(columns=rename)
+    table = table.rename_columns([rename[c] for c in table.column_names])
+
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def clean_unique(s, clean_fn):
     """
-    if type(s) is str:
-        s = [clean_fn(r) for r in s.split(delimiter)]
+    Cleans a Series of user names, calling clean_fn once on the distinct names
+    rather than on every row.
+    """
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    cleaned = clean_fn(pd.Series(uniques))
 
-        return s
-    else:
-        return []
+    return cleaned.take(codes).set_axis(s.index)
 
 
 def convert_time(s):
     """
-    Converts string times to a standard float datetime.
+    Converts a string time to seconds since the Unix epoch.
     """
     try:
-        (date, time) = s.split(" ")
-        iso = date + "T" + time
-        dt = ciso8601.parse_datetime(iso)
-        return int(np.round(dt.timestamp()))
-    except:
+        dt = datetime.fromisoformat(s)
+    except ValueError:
+        try:
+            (date, time) = s.split(" ")
+            dt = ciso8601.parse_datetime(date + "T" + time)
+        except:
+            return -1
+
+    # Times without an offset are UTC, as in convert_times.
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    try:
+        return round(dt.timestamp())
+    except (OverflowError, ValueError):
         return -1
 
 
-def expand(row):
+def convert_times(s):
     """
-    Expands a tuple with multiple receivers into a data frame,
-    where the sender and time are constant and each row has a single receiver.
+    Converts a Series of string times to seconds since the Unix epoch. Times
+    that pandas cannot parse fall back to convert_time.
     """
-    r = np.empty((len(row[1]), len(row)), dtype=object)
-    r[:] = row
-    for i in range(r.shape[0]):
-        r[i, 1] = row[1][i]
-    return r
+    # Work in microseconds so that times outside the nanosecond range (before
+    # 1677 or after 2262) do not overflow when the epoch is subtracted.
+    ts = pd.to_datetime(s, format="ISO8601", errors="coerce", utc=True)
+    ts = ts.dt.as_unit("us")
+    epoch = pd.Timestamp(0, tz="UTC").as_unit("us")
+    seconds = ((ts - epoch) / pd.Timedelta(seconds=1)).round()
+
+    failed = ts.isna() & s.notna()
+    seconds[failed] = s[failed].apply(convert_time)
+
+    return seconds.fillna(-1).astype("int64")
 
 
-def clean(df, start, end, clean_fn, delimiter):
+def clean(df, start, end, clean_fn, delimiter, dataset_name):
     """
     Cleans the dataset. Ensures that sender and receiver information is set, and
     times are between start and end. Then factorizes the senders and receivers.
-    Returns a cleaned dataframe.
-    """
-    print("initial: ", df.shape)
-    df.sender = df.sender.apply(clean_fn)
-    df.receiver = df.receiver.apply(lambda x:
-                                    clean_multiple(x, clean_fn, delimiter))
-    df.submit = df.submit.apply(convert_time)
-
-    reorder_cols = ["sender", "receiver", "submit", "cc", "bcc"]
-    df = df[reorder_cols].to_numpy()
-    df = np.concatenate([expand(df[i, :]) for i in range(df.shape[0])], axis=0)
-    print("expansion: ", df.shape)
-
-    df = pd.DataFrame(df, columns=reorder_cols)
-    sender_correct = df.sender.apply(lambda x: x != "" and x.lower() != "nan")
-    print("senders: ", sum(sender_correct), len(sender_correct))
-    receiver_correct = df.receiver.apply(
-        lambda x: x != "" and x.lower() != "nan")
-    print("receivers: ", sum(receiver_correct), len(receiver_correct))
-    time_correct = df.submit.apply(lambda x: start <= x and x <= end)
-    print("time: ", sum(time_correct), len(time_correct))
-    all_correct = sender_correct & receiver_correct & time_correct
+    Returns a cleaned dataframe. Progress is labelled with dataset_name, as
+    datasets may be cleaned in parallel.
+    """
+    print(f"[{dataset_name}] initial: ", df.shape)
+    df.sender = clean_unique(df.sender, clean_fn)
+    df.receiver = df.receiver.str.split(delimiter)
+    df.submit = convert_times(df.submit)
+
+    reorder_cols = ["sender", "receiver", "submit"]
+    df = df[reorder_cols].explode("receiver")
+    df = df.dropna(subset=["receiver"], ignore_index=True)
+    df.receiver = clean_unique(df.receiver, clean_fn)
+    print(f"[{dataset_name}] expansion: ", df.shape)
+
+    sender_correct = df.sender.ne("") & df.sender.str.lower().ne("nan")
+    print(f"[{dataset_name}] senders: ",
+          sender_correct.sum(), len(sender_correct))
+    receiver_correct = df.receiver.ne("") & df.receiver.str.lower().ne("nan")
+    print(f"[{dataset_name}] receivers: ",
+          receiver_correct.sum(), len(receiver_correct))
+    time_correct = df.submit.between(start, end)
+    print(f"[{dataset_name}] time: ", time_correct.sum(), len(time_correct))
+    all_correct = np.logical_and.reduce([
+        m.to_numpy(dtype=bool)
+        for m in (sender_correct, receiver_correct, time_correct)])
     df = df[all_correct]
-    print("final: ", df.shape)
-
-    stacked = df[["sender", "receiver"]].stack()
-    sender_receiver, user_key = stacked.factorize()
-    print("users: ", np.unique(user_key).shape)
-    df[["sender", "receiver"]] = pd.Series(
-        sender_receiver, index=stacked.index).unstack()
+    print(f"[{dataset_name}] final: ", df.shape)
+
+    # Interleave senders and receivers so that users are numbered in the order
+    # they first appear in the messages.
+    n = df.shape[0]
+    users = pd.concat([df.sender, df.receiver], ignore_index=True)
+    users = users.take(np.arange(2 * n).reshape(2, n).T.ravel())
+    sender_receiver, user_key = pd.factorize(users)
+    print(f"[{dataset_name}] users: ", user_key.shape)
+    sender_receiver = sender_receiver.astype(np.int32).reshape(n, 2)
+    df = df.assign(sender=sender_receiver[:, 0], receiver=sender_receiver[:, 1])
     clean_cols = ["sender", "receiver", "submit"]
 
     user_key = pd.DataFrame(user_key, columns=["user"])
     df = df[clean_cols]
-    df.sort_values(by=["submit", "sender", "receiver"], inplace=True)
+
+    # Sort by submit, sender, receiver. Packing the sender and receiver codes
+    # into one key leaves lexsort two keys to sort instead of three.
+    pair = df.sender.to_numpy().astype(np.uint64) << np.uint64(32)
+    pair |= df.receiver.to_numpy().astype(np.uint64)
+    df = df.iloc[np.lexsort((pair, df.submit.to_numpy()))]
 
     return df, user_key
 
@@ -196,46 +245,55 @@ def process(data_path, url, dataset_name, delimiter, rename, clean_sender_fn, st
     if not os.path.exists(dataset_path):
         os.makedirs(dataset_path)
 
-    zip_path = os.path.join(dataset_path, "raw.zip")
-    if not os.path.exists(zip_path):
-        print(f"Downloading: {url}...")
-        download(url, zip_path, dataset_path)
-        print("done.")
+    raw_path = os.path.join(dataset_path, "raw.csv")
+    if not os.path.exists(raw_path):
+        print(f"[{dataset_name}] Downloading: {url}...")
+        download(url, dataset_path)
+        print(f"[{dataset_name}] done.")
 
     clean_path = os.path.join(
-        dataset_path, f"clean.csv")
+        dataset_path, f"clean.parquet")
     if not os.path.exists(clean_path):
-        print(f"Creating: {clean_path}...")
+        print(f"[{dataset_name}] Creating: {clean_path}...")
 
-        raw_path = os.path.join(dataset_path, "raw.csv")
-        raw_df = pd.read_csv(raw_path, usecols=rename.keys())
-        raw_df.rename(columns=rename, inplace=True)
+        raw_df = read_raw(raw_path, rename)
         clean_df, user_key = clean(
-            raw_df, start, end, clean_sender_fn, delimiter)
-        print("done.")
+            raw_df, start, end, clean_sender_fn, delimiter, dataset_name)
+        print(f"[{dataset_name}] done.")
 
-        clean_df.to_csv(clean_path, index=False)
+        clean_df.to_parquet(clean_path, engine="pyarrow",
+                            compression="zstd", index=False)
 
         user_key_path = os.path.join(
             dataset_path, f"users.csv")
         user_key.to_csv(user_key_path)
     else:
-        clean_df = pd.read_csv(clean_path)
+        clean_df = pd.read_parquet(clean_path, engine="pyarrow")
 
 
 def main(data_path, enron, seattle):
     """
     Downloads the datasets if not available, then cleans and processes them.
+    When both datasets are selected they are processed in parallel.
     """
 
+    datasets = []
     if enron:
-        parameters = ENRON_PARAMETERS
-    elif seattle:
-        parameters = SEATTLE_PARAMETERS
-    else:
+        datasets.append(ENRON_PARAMETERS)
+    if seattle:
+        datasets.append(SEATTLE_PARAMETERS)
+    if not datasets:
         raise ValueError("Unrecognized dataset. Expects `enron` or `seattle`.")
 
-    process(data_path, *parameters)
+    if len(datasets) == 1:
+        process(data_path, *datasets[0])
+        return
+
+    with ProcessPoolExecutor(max_workers=len(datasets)) as executor:
+        futures = [executor.submit(process, data_path, *parameters)
+                   for parameters in datasets]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+import pandas as pd
+import pyarrow as pa
+
+from clean import convert_time, convert_times, read_raw
+
+
+def test_convert_times_out_of_nanosecond_range():
+    s = pd.Series(["2001-05-14 16:39:00-07:00", "0001-05-30 12:00:00-07:00",
+                   "not a time", None],
+                  dtype=pd.ArrowDtype(pa.string()))
+
+    assert convert_times(s).tolist() == [989883540, -62122654800, -1, -1]
+
+
+def test_convert_time_naive_is_utc():
+    assert convert_time("2001-05-14 23:39:00") == 989883540
+    assert convert_time("0001-01-01 00:00:00") == -62135596800
+    assert convert_time("not a time") == -1
+
+
+def test_read_raw_null_values(tmp_path):
+    raw_path = tmp_path / "raw.csv"
+    raw_path.write_text("From,To,X-cc,Date\n"
+                        "None,<NA>,NULL,2001-05-14 16:39:00-07:00\n")
+    rename = {"From": "sender", "To": "receiver", "Date": "submit"}
+
+    df = read_raw(str(raw_path), rename)
+
+    assert list(df.columns) == ["sender", "receiver", "submit"]
+    assert df[["sender", "receiver"]].isna().all(axis=None)
+    assert df.submit[0] == "2001-05-14 16:39:00-07:00"
+
+
+def test_read_raw_record_larger_than_block(tmp_path):
+    raw_path = tmp_path / "raw.csv"
+    body = "line\n" * 500000
+    raw_path.write_text("From,To,Body,Date\n"
+                        f"a@x.com,b@x.com,\"{body}\",2001-05-14 16:39:00-07:00\n"
+                        "None,<NA>,x,2001-05-14 16:39:00-07:00\n")
+    rename = {"From": "sender", "To": "receiver", "Date": "submit"}
+
+    df = read_raw(str(raw_path), rename)
+
+    assert list(df.columns) == ["sender", "receiver", "submit"]
+    assert df.sender[0] == "a@x.com"
+    assert df[["sender", "receiver"]].iloc[1].isna().all()